@@ -1,13 +1,24 @@
-import datetime
+import errno
+import functools
 import json
 import logging
+import mmap
+import multiprocessing
 import os
 import pathlib
+import re
 import shutil
-import tarfile
+import stat
+import struct
+import subprocess
+import tempfile
+import time
 from pathlib import Path
 from typing import Optional
 import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from jupyter_core.utils import ensure_async
 from jupyter_server.base.handlers import APIHandler
@@ -16,7 +27,15 @@ from tornado import ioloop, web
 
 
 QIIME_DIR_NAME = "_qiime"
-QIIME_TIMESTAMP_FILE = "_created"
+QIIME_SCRATCH_PREFIX = ".extracting-"
+COPY_BUFSIZE = 1 << 20
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+ZIP_LOCAL_HEADER_SIZE = 30
+QIIME_CLEANUP_INTERVAL_MS = 60 * 60 * 1000
+UNZIP_SIZE_THRESHOLD = 32 << 20
+EXTRACT_MAX_WORKERS = 2
+UUID_PATTERN = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+KERNEL_COPY_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP, errno.EXDEV)
 
 def make_reader(archive_path: Path):
     archive_format = "".join(archive_path.suffixes)
@@ -30,22 +49,36 @@ def make_reader(archive_path: Path):
 def get_uuid(qzv_path: pathlib.Path) -> Optional[str]:
     """Extracted root directory should be of UUID format
     """
-    # Open the QZV file
-    with zipfile.ZipFile(qzv_path, mode='r') as myzip:
-        # Get the list of all files and directories in the zip
-        p = Path(myzip.namelist()[0])
-        uuid = p.parts[0] if p.parts else None
+    st = qzv_path.stat()
+    return _get_uuid_cached(str(qzv_path), st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_uuid_cached(qzv_path: str, mtime_ns: int, size: int) -> Optional[str]:
+    """Read the UUID once per (path, mtime, size); a changed file misses the cache
+    """
+    # Read just the first local file header instead of the central directory
+    with open(qzv_path, mode='rb') as f:
+        header = f.read(ZIP_LOCAL_HEADER_SIZE)
+        if len(header) < ZIP_LOCAL_HEADER_SIZE or header[:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+            return None
+        (flags,) = struct.unpack_from("<H", header, 6)
+        (name_len,) = struct.unpack_from("<H", header, 26)
+        name = f.read(name_len)
+
+    # Bit 11 of the general purpose flag marks UTF-8 names, as in zipfile
+    p = Path(name.decode("utf-8" if flags & 0x800 else "cp437"))
+    uuid = p.parts[0] if p.parts else None
 
     return uuid
 
 
-def write_timestamp(uuid_str: str) -> None:
-    """Record zip-extraction date to ~/_qiime/{uuid_str}/_created
+def is_extracted(uuid_dir: Path) -> bool:
+    """Check if ~/_qiime/{uuid} exists and has not been cleaned up yet
+
+    The directory is renamed into place only after a complete extraction.
     """
-    p = Path.home() / QIIME_DIR_NAME / uuid_str / QIIME_TIMESTAMP_FILE
-    with p.open("w") as f:
-        date = datetime.date.today().isoformat()
-        print(date, file=f)
+    return uuid_dir.is_dir()
 
 
 def prepare_qiime_dir() -> Path:
@@ -57,21 +90,188 @@ def prepare_qiime_dir() -> Path:
 def cleanup_qiime_dir(interval_threshold=10) -> None:
     """Remove over-10-day-old directories in ~/_qiime for cleanup"""
     root = prepare_qiime_dir()
-    paths = root.glob(f"*/{QIIME_TIMESTAMP_FILE}")
-
-    today = datetime.datetime.today()
-    for p in paths:
-        with p.open() as f:
-            datestr = f.read().strip()
-        creation_date = datetime.datetime.strptime(datestr, "%Y-%m-%d")
-        delta = today - creation_date
-        if delta.days > interval_threshold:
-            dirpath = p.parent
+    threshold = interval_threshold * 24 * 60 * 60
+
+    now = time.time()
+    with os.scandir(root) as it:
+        for entry in it:
+            # Scratch directories belong to extractions that are still running
+            if entry.name.startswith(QIIME_SCRATCH_PREFIX):
+                continue
             try:
-                shutil.rmtree(dirpath)
-                logging.info(f"Cleaning up outdated directory: {dirpath}")
-            except OSError as e:
-                logging.error(f"Error: {e.filename} - {e.strerror}.")
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                # Directory mtime is refreshed with os.utime on every request
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                # Removed since scandir listed it
+                continue
+            if now - mtime > threshold:
+                try:
+                    shutil.rmtree(entry.path)
+                    logging.info(f"Cleaning up outdated directory: {entry.path}")
+                except OSError as e:
+                    logging.error(f"Error: {e.filename} - {e.strerror}.")
+
+
+def schedule_cleanup_qiime_dir() -> None:
+    """Run cleanup_qiime_dir in a worker thread to keep rmtree off the event loop"""
+    future = ioloop.IOLoop.current().run_in_executor(None, cleanup_qiime_dir)
+    future.add_done_callback(log_cleanup_error)
+
+
+def log_cleanup_error(future) -> None:
+    """Log the error of a scheduled cleanup_qiime_dir, since nothing awaits it"""
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Failed to clean up ~/%s", QIIME_DIR_NAME, exc_info=future.exception())
+
+
+
+_extract_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_extract_pool() -> ProcessPoolExecutor:
+    """Process pool for extraction, so decompression does not hold the server's GIL"""
+    global _extract_pool
+    if _extract_pool is None:
+        # Forking the threaded server can deadlock a child on an inherited lock
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        # os.cpu_count() reports the host's CPUs, not the container's limit
+        max_workers = min(EXTRACT_MAX_WORKERS, os.cpu_count() or 1)
+        _extract_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+    return _extract_pool
+
+
+def reset_extract_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool, e.g. after a worker was OOM-killed, so the next extraction starts afresh"""
+    global _extract_pool
+    if _extract_pool is pool:
+        _extract_pool = None
+    pool.shutdown(wait=False)
+
+
+def get_member_data_offset(archive_file, info: zipfile.ZipInfo) -> int:
+    """Offset of a zip member's data in the raw archive file
+
+    The local header is read because its extra field may differ from the one
+    recorded in the central directory.
+    """
+    archive_file.seek(info.header_offset)
+    header = archive_file.read(ZIP_LOCAL_HEADER_SIZE)
+    if len(header) < ZIP_LOCAL_HEADER_SIZE or header[:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"Bad local file header: {info.filename}")
+    name_len, extra_len = struct.unpack_from("<HH", header, 26)
+    return info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len + extra_len
+
+
+def copy_file_range_at(in_fd: int, out_fd: int, offset: int, count: int) -> int:
+    """Copy count bytes at offset of in_fd to out_fd's position with os.copy_file_range"""
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "os.copy_file_range is not available")
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def sendfile_at(in_fd: int, out_fd: int, offset: int, count: int) -> int:
+    """Copy count bytes at offset of in_fd to out_fd's position with os.sendfile"""
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "os.sendfile is not available")
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+# Tried in order by copy_stored_member
+KERNEL_COPY_FUNCTIONS = (copy_file_range_at, sendfile_at)
+
+
+def check_member_crc(dst, info: zipfile.ZipInfo) -> None:
+    """Raise BadZipFile, as zipfile would, if dst does not match the member's CRC-32
+
+    dst must be open for reading as well, since it is mapped into memory.
+    """
+    crc = 0
+    if info.file_size:
+        with mmap.mmap(dst.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            crc = zlib.crc32(data)
+    if crc != info.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+
+
+def copy_stored_member(archive_file, info: zipfile.ZipInfo, dst) -> bool:
+    """Copy an uncompressed zip member into dst without a userspace copy
+
+    os.copy_file_range is tried first since it can share extents on
+    filesystems with reflink support, then os.sendfile. The copy is checked
+    against the member's CRC-32 afterwards. Returns False without writing
+    anything when neither works here, so the caller can fall back to zipfile.
+    """
+    start = get_member_data_offset(archive_file, info)
+    for kernel_copy in KERNEL_COPY_FUNCTIONS:
+        offset, end = start, start + info.file_size
+        try:
+            while offset < end:
+                copied = kernel_copy(archive_file.fileno(), dst.fileno(), offset, end - offset)
+                if copied == 0:
+                    raise zipfile.BadZipFile(f"Truncated file data: {info.filename}")
+                offset += copied
+            check_member_crc(dst, info)
+            return True
+        except OSError as e:
+            if offset == start and e.errno in KERNEL_COPY_UNSUPPORTED_ERRNOS:
+                continue
+            raise
+    return False
+
+
+def extract_member(archive: zipfile.ZipFile, raw, member: zipfile.ZipInfo, target: Path) -> None:
+    """Write a single zip member to target; raw is the archive file opened separately"""
+    if member.is_dir():
+        target.mkdir(parents=True, exist_ok=True)
+        return
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Readable too, so copy_stored_member can check the CRC-32 of the copy
+    with target.open("w+b") as dst:
+        is_plain_stored = member.compress_type == zipfile.ZIP_STORED and not member.flag_bits & 0x1
+        if not (is_plain_stored and copy_stored_member(raw, member, dst)):
+            # Copy in bounded chunks instead of reading whole members
+            with archive.open(member) as src:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+
+
+def extract_qzv(archive_path: Path, archive_destination: Path) -> None:
+    """Extract archive_path into archive_destination; runs in a worker process
+
+    Raises ValueError if a member would be written outside archive_destination.
+    """
+    destination = os.path.abspath(archive_destination)
+
+    unzip = shutil.which("unzip")
+
+    with make_reader(archive_path) as archive, open(archive_path, "rb") as raw:
+        members = archive.infolist()
+
+        # Check every file path before writing anything to avoid path traversal
+        # See https://nvd.nist.gov/vuln/detail/CVE-2007-4559
+        for member in members:
+            target = os.path.abspath(archive_destination / member.filename)
+            if os.path.commonpath([destination, target]) != destination:
+                raise ValueError(f"The archive file includes an unsafe file path: {member.filename}")
+            # unzip would recreate symlinks, which could point anywhere
+            if stat.S_ISLNK(member.external_attr >> 16):
+                raise ValueError(f"The archive file includes a symbolic link: {member.filename}")
+
+        use_unzip = unzip is not None and archive_path.stat().st_size > UNZIP_SIZE_THRESHOLD
+        if not use_unzip:
+            for member in members:
+                extract_member(archive, raw, member, archive_destination / member.filename)
+
+    if use_unzip:
+        # Every member was validated above; let Info-ZIP inflate large archives
+        args = [unzip, "-q", "-o", "-d", str(archive_destination), str(archive_path)]
+        result = subprocess.run(args)
+        # Exit status 1 only reports warnings; the files were extracted
+        if result.returncode not in (0, 1):
+            raise subprocess.CalledProcessError(result.returncode, args)
 
 
 
@@ -104,9 +304,17 @@ class ExtractQzvHandler(APIHandler):
             self.write(json.dumps({"data": msg}))
             raise web.HTTPError(500)
 
-        cleanup_qiime_dir()
-        await ioloop.IOLoop.current().run_in_executor(None, self.extract_qzv, qzv_path)
-        write_timestamp(uuid_str)
+        # uuid_str comes from a member name; it must not escape ~/_qiime
+        if not UUID_PATTERN.fullmatch(uuid_str):
+            error_message = f"The QZV root directory is not a UUID: {uuid_str}"
+            self.log.error(error_message)
+            raise web.HTTPError(400, reason=error_message)
+
+        archive_destination = prepare_qiime_dir()
+        uuid_dir = archive_destination / uuid_str
+        if not is_extracted(uuid_dir):
+            await self.extract(qzv_path, uuid_dir)
+        os.utime(uuid_dir, None)
 
         # slash at the tail matters
         service_prefix = os.environ.get("JUPYTERHUB_SERVICE_PREFIX", "/")
@@ -114,28 +322,32 @@ class ExtractQzvHandler(APIHandler):
         self.finish(json.dumps({"data": url}))
 
 
-    def extract_qzv(self, archive_path):
-        archive_destination = prepare_qiime_dir()
-        self.log.info("Begin extraction of {} to {}.".format(archive_path, archive_destination))
-
-        archive_reader = make_reader(archive_path)
-
-        if isinstance(archive_reader, tarfile.TarFile):
-            # Check file path to avoid path traversal
-            # See https://nvd.nist.gov/vuln/detail/CVE-2007-4559
-            with archive_reader as archive:
-                for name in archive_reader.getnames():
-                    if os.path.relpath(archive_destination / name, archive_destination).startswith(os.pardir):
-                        error_message = f"The archive file includes an unsafe file path: {name}"
-                        self.log.error(error_message)
-                        raise web.HTTPError(400, reason=error_message)
-            # Re-open stream
-            archive_reader = make_reader(archive_path)
-
-        with archive_reader as archive:
-            archive.extractall(archive_destination)
-
-        self.log.info("Finished extracting {} to {}.".format(archive_path, archive_destination))
+    async def extract(self, qzv_path: Path, uuid_dir: Path) -> None:
+        # Extract into a scratch directory and rename it into place once done,
+        # so other requests never see a partially extracted uuid_dir
+        scratch_dir = Path(tempfile.mkdtemp(prefix=QIIME_SCRATCH_PREFIX, dir=uuid_dir.parent))
+        try:
+            pool = get_extract_pool()
+            # Log here; the worker process has no logging handlers configured
+            self.log.info("Begin extraction of {} to {}.".format(qzv_path, uuid_dir))
+            try:
+                await ioloop.IOLoop.current().run_in_executor(pool, extract_qzv, qzv_path, scratch_dir)
+            except ValueError as e:
+                error_message = str(e)
+                self.log.error(error_message)
+                raise web.HTTPError(400, reason=error_message)
+            except BrokenProcessPool:
+                reset_extract_pool(pool)
+                raise
+            try:
+                os.rename(scratch_dir / uuid_dir.name, uuid_dir)
+            except OSError:
+                # Another request finished extracting the same QZV first
+                if not is_extracted(uuid_dir):
+                    raise
+            self.log.info("Finished extracting {} to {}.".format(qzv_path, uuid_dir))
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
 
 
 
@@ -147,3 +359,7 @@ def setup_handlers(web_app):
         (url_path_join(base_url, r"/extract-qzv/(.*)"), ExtractQzvHandler),
     ]
     web_app.add_handlers(host_pattern, handlers)
+
+    # PeriodicCallback first fires one interval after start, so also clean up now
+    ioloop.IOLoop.current().add_callback(schedule_cleanup_qiime_dir)
+    ioloop.PeriodicCallback(schedule_cleanup_qiime_dir, QIIME_CLEANUP_INTERVAL_MS).start()
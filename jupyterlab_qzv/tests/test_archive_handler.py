@@ -1,12 +1,45 @@
+import contextlib
+import errno
+import os
 import platform
 import shutil
+import stat
 import tarfile
+import time
 import zipfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
 
 import pytest
 
 from tornado.httpclient import HTTPClientError
 
+import jupyterlab_qzv.handlers
+from jupyterlab_qzv.handlers import (
+    QIIME_DIR_NAME,
+    QIIME_SCRATCH_PREFIX,
+    cleanup_qiime_dir,
+    extract_qzv,
+    get_extract_pool,
+    get_uuid,
+    log_cleanup_error,
+)
+
+QZV_UUID = "5a8c7a6e-0b2f-4c1d-9e3a-7f6b5d4c3b2a"
+INDEX_NAME = f"{QZV_UUID}/data/index.html"
+
+
+def _iter_files(root):
+    # Use the dirent type from scandir instead of a stat per entry
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                yield Path(entry.path)
+            elif entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(entry.path)
+
+
 @pytest.mark.parametrize(
     "format, mode",
     [
@@ -37,14 +70,12 @@ def _create_archive_file(root_dir, file_name, format, mode):
     archive_path = archive_dir_path.parent / f"{archive_dir_path.name}.{format}"
     if format == "zip":
         with zipfile.ZipFile(archive_path, mode=mode) as writer:
-            for file_path in archive_dir_path.rglob("*"):
-                if file_path.is_file():
-                    writer.write(file_path, file_path.relative_to(root_dir))
+            for file_path in _iter_files(archive_dir_path):
+                writer.write(file_path, file_path.relative_to(root_dir))
     else:
         with tarfile.open(str(archive_path), mode=mode) as writer:
-            for file_path in archive_dir_path.rglob("*"):
-                if file_path.is_file():
-                    writer.add(file_path, file_path.relative_to(root_dir))
+            for file_path in _iter_files(archive_dir_path):
+                writer.add(file_path, file_path.relative_to(root_dir))
 
     # Remove the directory
     shutil.rmtree(archive_dir_path)
@@ -52,6 +83,30 @@ def _create_archive_file(root_dir, file_name, format, mode):
     return archive_dir_path, archive_path
 
 
+@pytest.fixture
+def destination(tmp_path):
+    destination = tmp_path / "dest"
+    destination.mkdir()
+    return destination
+
+
+def _create_qzv(archive_path, members=None, compression=zipfile.ZIP_STORED):
+    # members maps a name or ZipInfo to its data; defaults to a single index page
+    if members is None:
+        members = {INDEX_NAME: "hello"}
+    with zipfile.ZipFile(archive_path, "w", compression=compression) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return archive_path
+
+
+def _corrupt_member(archive_path, name):
+    # Flip the first data byte of the last member, which must be `name`
+    data = bytearray(archive_path.read_bytes())
+    data[data.rindex(b"PK\x03\x04") + 30 + len(name)] ^= 0xFF
+    archive_path.write_bytes(bytes(data))
+
+
 @pytest.mark.parametrize(
     "file_name",
     [
@@ -128,3 +183,218 @@ async def test_extract_path_traversal(jp_fetch, jp_root_dir, file_path):
         await jp_fetch("extract-qzv", archive_path.relative_to(jp_root_dir).as_posix(), method="GET")
     assert e.type == HTTPClientError
     assert e.value.code == 400
+
+
+@pytest.mark.parametrize(
+    "file_path",
+    [
+        ("../../../../../../../../../../tmp/test"),
+        ("../test"),
+        ("../evil/data/index.html"),
+        ("/abs/data/index.html"),
+    ],
+)
+@pytest.mark.parametrize("unsafe_first", [False, True])
+async def test_extract_qzv_path_traversal(jp_fetch, jp_root_dir, file_path, unsafe_first):
+    # The first member names the root directory, which skips extraction if it exists
+    members = [(INDEX_NAME, "hello"), (file_path, "hello")]
+    if unsafe_first:
+        members.reverse()
+    archive_path = _create_qzv(jp_root_dir / "test.qzv", dict(members))
+
+    with pytest.raises(Exception) as e:
+        await jp_fetch("extract-qzv", archive_path.relative_to(jp_root_dir).as_posix(), method="GET")
+    assert e.type == HTTPClientError
+    assert e.value.code == 400
+
+
+async def test_extract_qzv_requires_uuid_root(jp_fetch, jp_root_dir):
+    _create_qzv(jp_root_dir / "test.qzv", {"not-a-uuid/data/index.html": "hello"})
+
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("extract-qzv", "test.qzv", method="GET")
+    assert e.value.code == 400
+    assert not (Path.home() / QIIME_DIR_NAME / "not-a-uuid").exists()
+
+
+def test_get_uuid_follows_file_changes(tmp_path):
+    archive_path = _create_qzv(tmp_path / "test.qzv")
+    assert get_uuid(archive_path) == QZV_UUID
+    assert get_uuid(archive_path) == QZV_UUID
+
+    other_uuid = "0d9e8f7a-6b5c-4d3e-8f2a-1b0c9d8e7f6a"
+    _create_qzv(archive_path, {f"{other_uuid}/data/index.html": "hello, world"})
+    assert get_uuid(archive_path) == other_uuid
+
+
+def test_get_uuid_not_a_zip(tmp_path):
+    archive_path = tmp_path / "test.qzv"
+    archive_path.write_text("not a zip file")
+    assert get_uuid(archive_path) is None
+
+
+def test_cleanup_qiime_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    root = tmp_path / QIIME_DIR_NAME
+    scratch_name = f"{QIIME_SCRATCH_PREFIX}old"
+    for name in ("old", "new", scratch_name):
+        (root / name).mkdir(parents=True)
+    eleven_days_ago = time.time() - 11 * 24 * 60 * 60
+    for name in ("old", scratch_name):
+        os.utime(root / name, (eleven_days_ago, eleven_days_ago))
+
+    cleanup_qiime_dir()
+    assert not (root / "old").exists()
+    assert (root / "new").is_dir()
+    assert (root / scratch_name).is_dir()
+
+
+def test_cleanup_qiime_dir_vanished_entry(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    root = tmp_path / QIIME_DIR_NAME
+    for name in ("gone", "old"):
+        (root / name).mkdir(parents=True)
+    eleven_days_ago = time.time() - 11 * 24 * 60 * 60
+    os.utime(root / "old", (eleven_days_ago, eleven_days_ago))
+
+    # Remove "gone" between scandir and stat, as a finished extraction would
+    real_scandir = os.scandir
+
+    @contextlib.contextmanager
+    def scandir(path):
+        monkeypatch.setattr(os, "scandir", real_scandir)
+        with real_scandir(path) as it:
+            entries = list(it)
+        os.rmdir(root / "gone")
+        yield iter(entries)
+
+    monkeypatch.setattr(os, "scandir", scandir)
+    cleanup_qiime_dir()
+    assert not (root / "old").exists()
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_extract_qzv_members(tmp_path, destination, compression):
+    contents = {INDEX_NAME: b"hello" * 1000, f"{QZV_UUID}/empty.txt": b""}
+    archive_path = _create_qzv(tmp_path / "test.qzv", {f"{QZV_UUID}/data/": "", **contents}, compression)
+
+    extract_qzv(archive_path, destination)
+    for name, data in contents.items():
+        assert (destination / name).read_bytes() == data
+
+
+def test_extract_qzv_unsafe_writes_nothing(tmp_path, destination):
+    members = {INDEX_NAME: "hello", "other/index.html": "hello", "../test": "hello"}
+    archive_path = _create_qzv(tmp_path / "test.qzv", members)
+
+    with pytest.raises(ValueError):
+        extract_qzv(archive_path, destination)
+    assert list(destination.iterdir()) == []
+
+
+async def test_extract_qzv_skips_extracted(jp_fetch, jp_root_dir, caplog):
+    _create_qzv(jp_root_dir / "test.qzv")
+
+    r = await jp_fetch("extract-qzv", "test.qzv", method="GET")
+    assert r.code == 200
+    assert "Finished extracting" in caplog.text
+    index_path = Path.home() / QIIME_DIR_NAME / INDEX_NAME
+    index_path.write_text("extracted once")
+    mtime = index_path.stat().st_mtime_ns
+
+    r = await jp_fetch("extract-qzv", "test.qzv", method="GET")
+    assert r.code == 200
+    assert index_path.read_text() == "extracted once"
+    assert index_path.stat().st_mtime_ns == mtime
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+async def test_extract_qzv_failure_leaves_nothing(jp_fetch, jp_root_dir, compression):
+    broken_name = f"{QZV_UUID}/data/broken.html"
+    archive_path = _create_qzv(
+        jp_root_dir / "test.qzv", {INDEX_NAME: "hello", broken_name: "hello" * 1000}, compression
+    )
+    # Corrupt the last member so extraction fails halfway
+    _corrupt_member(archive_path, broken_name)
+
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("extract-qzv", "test.qzv", method="GET")
+    assert e.value.code == 500
+    assert list((Path.home() / QIIME_DIR_NAME).iterdir()) == []
+
+
+def test_log_cleanup_error(caplog):
+    future = Future()
+    future.set_exception(OSError("scandir failed"))
+    log_cleanup_error(future)
+    assert "scandir failed" in caplog.text
+
+
+async def test_extract_recovers_from_dead_worker(jp_fetch, jp_root_dir):
+    _create_qzv(jp_root_dir / "test.qzv")
+
+    # Kill a worker as the OOM killer would
+    with pytest.raises(BrokenProcessPool):
+        get_extract_pool().submit(os._exit, 1).result()
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("extract-qzv", "test.qzv", method="GET")
+    assert e.value.code == 500
+
+    r = await jp_fetch("extract-qzv", "test.qzv", method="GET")
+    assert r.code == 200
+
+
+@pytest.mark.skipif(shutil.which("unzip") is None, reason="unzip is not installed")
+def test_extract_qzv_with_unzip(tmp_path, destination, monkeypatch):
+    monkeypatch.setattr(jupyterlab_qzv.handlers, "UNZIP_SIZE_THRESHOLD", 0)
+    archive_path = _create_qzv(tmp_path / "test.qzv", {INDEX_NAME: "hello" * 1000}, zipfile.ZIP_DEFLATED)
+
+    extract_qzv(archive_path, destination)
+    assert (destination / INDEX_NAME).read_text() == "hello" * 1000
+
+
+@pytest.mark.parametrize("threshold", [0, 1 << 40])
+def test_extract_qzv_rejects_symlink(tmp_path, destination, monkeypatch, threshold):
+    monkeypatch.setattr(jupyterlab_qzv.handlers, "UNZIP_SIZE_THRESHOLD", threshold)
+    link = zipfile.ZipInfo(f"{QZV_UUID}/data/secret")
+    link.external_attr = (stat.S_IFLNK | 0o777) << 16
+    archive_path = _create_qzv(tmp_path / "test.qzv", {INDEX_NAME: "hello", link: "/etc/passwd"})
+
+    with pytest.raises(ValueError):
+        extract_qzv(archive_path, destination)
+    assert list(destination.iterdir()) == []
+
+
+def _raise_exdev(in_fd, out_fd, offset, count):
+    raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+
+@pytest.mark.parametrize(
+    "kernel_copy_functions",
+    [
+        (_raise_exdev, jupyterlab_qzv.handlers.sendfile_at),
+        (_raise_exdev,),
+    ],
+)
+def test_extract_qzv_kernel_copy_fallback(tmp_path, destination, monkeypatch, kernel_copy_functions):
+    monkeypatch.setattr(jupyterlab_qzv.handlers, "KERNEL_COPY_FUNCTIONS", kernel_copy_functions)
+    data = os.urandom(3 << 20)
+    table_name = f"{QZV_UUID}/data/table.bin"
+    archive_path = _create_qzv(tmp_path / "test.qzv", {INDEX_NAME: "hello", table_name: data})
+
+    extract_qzv(archive_path, destination)
+    assert (destination / INDEX_NAME).read_text() == "hello"
+    assert (destination / table_name).read_bytes() == data
+
+
+@pytest.mark.parametrize(
+    "kernel_copy",
+    [jupyterlab_qzv.handlers.copy_file_range_at, jupyterlab_qzv.handlers.sendfile_at],
+)
+def test_extract_qzv_kernel_copy_checks_crc(tmp_path, destination, monkeypatch, kernel_copy):
+    monkeypatch.setattr(jupyterlab_qzv.handlers, "KERNEL_COPY_FUNCTIONS", (kernel_copy,))
+    archive_path = _create_qzv(tmp_path / "test.qzv", {INDEX_NAME: "hello" * 1000})
+    _corrupt_member(archive_path, INDEX_NAME)
+
+    with pytest.raises(zipfile.BadZipFile, match="Bad CRC-32"):
+        extract_qzv(archive_path, destination)